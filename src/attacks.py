@@ -4,29 +4,203 @@ import models
 import trainer
 import utils
 
-import numpy as np
-from scipy.stats import norm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import MLP
-from torch.utils.data import DataLoader
-from torchmetrics import Accuracy
 from tqdm.auto import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+import hashlib
+import io
 
 
+def train_shadow_model(skeleton, shadow_dataset, config, device, stream=None):
+    ''' Train a freshly initialized copy of the skeleton model on the shadow dataset. '''
+    train_config = trainer.TrainConfig(
+        criterion=trainer.accuracy,
+        device=device,
+        epochs=config.epochs_target,
+        early_stopping=config.early_stopping,
+        loss_fn=F.cross_entropy,
+        lr=config.lr,
+        weight_decay=config.weight_decay,
+        optimizer=getattr(torch.optim, config.optimizer),
+        amp=config.amp,
+        amp_dtype=getattr(torch, config.amp_dtype),
+    )
+    shadow_model = deepcopy(skeleton)
+    shadow_model.reset_parameters()
+    # Only the training is compiled, the returned model stays a plain module that can be stacked for queries.
+    trained_model = utils.compile_model(shadow_model) if config.compile else shadow_model
+    with torch.cuda.stream(stream):
+        shadow_dataset.to(device, non_blocking=torch.device(device).type == 'cuda')
+        _ = trainer.train_gnn(
+            model=trained_model,
+            dataset=shadow_dataset,
+            config=train_config,
+            use_tqdm=False,
+        )
+    if stream is not None:
+        stream.synchronize()
+    return shadow_model
+
+def train_shadow_models_on_gpu(rank, world_size, skeleton, shadow_datasets, config, queue, seed):
+    ''' Worker process training every world_size:th shadow model on GPU number rank. '''
+    torch.cuda.set_device(rank)
+    # Spawned processes start from the same default seed, so without an offset per rank
+    # the workers would draw identical initializations and dropout masks.
+    torch.manual_seed(seed + rank)
+    for i in range(rank, len(shadow_datasets), world_size):
+        shadow_model = train_shadow_model(skeleton, shadow_datasets[i], config, device=f'cuda:{rank}')
+        # Send the weights as serialized bytes. Tensors would be shared through file descriptors
+        # that the parent fetches from this process, which fails once the worker has exited.
+        buffer = io.BytesIO()
+        torch.save({k: v.cpu() for k, v in shadow_model.state_dict().items()}, buffer)
+        queue.put((i, buffer.getvalue()))
+
+def fit_shadow_models(skeleton, shadow_datasets, config, desc=""):
+    '''
+    Train one copy of the skeleton model on each of the shadow datasets.
+    With the multi_gpu flag, the shadow models are split between one process per visible GPU.
+    Otherwise, on CUDA, the trainings are spread over config.num_streams concurrent streams,
+    since a single training on a small graph leaves most of the GPU idle.
+    '''
+    use_cuda = torch.device(config.device).type == 'cuda'
+    world_size = torch.cuda.device_count() if config.multi_gpu and use_cuda else 1
+    if world_size > 1:
+        # The shadow models are independent, so no gradient synchronization is needed, only gathering the weights.
+        # The datasets are sent to the workers from host memory, each worker copies its share to its own GPU.
+        shadow_datasets = [shadow_dataset.cpu() for shadow_dataset in shadow_datasets]
+        # Derive the worker seeds from the parent generator, so that a seeded run stays reproducible.
+        seed = int(torch.randint(2**62, ()).item())
+        queue = torch.multiprocessing.get_context('spawn').SimpleQueue()
+        context = torch.multiprocessing.spawn(
+            train_shadow_models_on_gpu,
+            args=(world_size, skeleton, shadow_datasets, config, queue, seed),
+            nprocs=world_size,
+            join=False,
+        )
+        shadow_models = [None] * len(shadow_datasets)
+        num_received = 0
+        with tqdm(total=len(shadow_datasets), desc=desc) as progress:
+            while num_received < len(shadow_datasets):
+                if queue.empty():
+                    # Poll the workers instead of blocking on the queue, join raises if a worker failed.
+                    if context.join(timeout=1) and queue.empty():
+                        raise RuntimeError(
+                            f"Shadow model workers exited after sending {num_received}/{len(shadow_datasets)} models."
+                        )
+                    continue
+                i, state_bytes = queue.get()
+                shadow_models[i] = deepcopy(skeleton)
+                shadow_models[i].load_state_dict(torch.load(io.BytesIO(state_bytes)))
+                shadow_models[i].to(config.device)
+                num_received += 1
+                progress.update()
+        context.join()
+        return shadow_models
+
+    if use_cuda and not any(shadow_dataset.x.is_cuda for shadow_dataset in shadow_datasets):
+        # Pinned memory allows asynchronous copies to the GPU.
+        shadow_datasets = [shadow_dataset.pin_memory() for shadow_dataset in shadow_datasets]
+    num_streams = config.num_streams
+    if num_streams > 1 and use_cuda:
+        streams = [torch.cuda.Stream() for _ in range(num_streams)]
+        # The shadow subgraphs may have been built on the device by kernels on the current stream,
+        # which must finish before the side streams read them.
+        for stream in streams:
+            stream.wait_stream(torch.cuda.current_stream())
+        with ThreadPoolExecutor(max_workers=num_streams) as executor:
+            futures = [
+                executor.submit(train_shadow_model, skeleton, shadow_dataset, config, config.device, streams[i % num_streams])
+                for i, shadow_dataset in enumerate(shadow_datasets)
+            ]
+            return [future.result() for future in tqdm(futures, desc=desc)]
+    return [
+        train_shadow_model(skeleton, shadow_dataset, config, config.device)
+        for shadow_dataset in tqdm(shadow_datasets, desc=desc)
+    ]
+
+def shadow_models_cache_path(population, num_nodes, config):
+    '''
+    Path to the cached shadow models trained on the population with the given configuration.
+    The population is identified by a hash of its graph, since it is resampled in every experiment.
+    The key also holds the seed of the current experiment, which determines the sampled shadow subgraphs.
+    '''
+    digest = hashlib.sha256()
+    for tensor in population.x, population.edge_index, population.y:
+        digest.update(tensor.cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    training_params = (
+        config.model,
+        num_nodes,
+        config.num_shadow_models,
+        config.hidden_dim_target,
+        config.dropout,
+        config.epochs_target,
+        config.early_stopping,
+        config.lr,
+        config.weight_decay,
+        config.optimizer,
+        config.amp,
+        config.amp_dtype,
+        torch.initial_seed(),
+    )
+    digest.update(repr(training_params).encode())
+    return Path(config.cachedir) / f'shadow_models_{digest.hexdigest()[:16]}.pt'
+
+def train_shadow_models(population, num_nodes, config, desc=""):
+    '''
+    Train config.num_shadow_models models on subgraphs with num_nodes nodes sampled from the population.
+    With the use_cache flag, the trained models are stored in config.cachedir and loaded
+    instead of retrained when the same population and training configuration reappears.
+    '''
+    if config.compile:
+        # Keep the compiled graphs for the differently sized shadow subgraphs instead of recompiling.
+        torch._dynamo.config.cache_size_limit = max(64, config.num_shadow_models)
+    skeleton = utils.fresh_model(
+        model_type=config.model,
+        num_features=population.num_features,
+        hidden_dim=config.hidden_dim_target,
+        num_classes=population.num_classes,
+        dropout=config.dropout,
+    )
+    if config.use_cache:
+        cache_path = shadow_models_cache_path(population, num_nodes, config)
+        if cache_path.exists():
+            shadow_models = []
+            for state_dict in torch.load(cache_path, map_location=config.device):
+                shadow_model = deepcopy(skeleton)
+                shadow_model.load_state_dict(state_dict)
+                shadow_models.append(shadow_model.to(config.device))
+            return shadow_models
+    # Sample all subgraphs up front, to keep host work out of the training loop.
+    shadow_datasets = [datasetup.sample_subgraph(population, num_nodes) for _ in range(config.num_shadow_models)]
+    shadow_models = fit_shadow_models(skeleton, shadow_datasets, config, desc=desc)
+    if config.use_cache:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save([shadow_model.state_dict() for shadow_model in shadow_models], cache_path)
+    return shadow_models
+
 class BasicShadowAttack:
     
-    def __init__(self, target_model, shadow_dataset, config):
+    def __init__(self, target_model, shadow_dataset, config, shadow_model=None):
+        ''' A shadow model from a previous attack can be passed to be re-initialized instead of constructed. '''
         target_model.eval()
         self.target_model = target_model
-        self.shadow_model = utils.fresh_model(
-            model_type=config.model,
-            num_features=shadow_dataset.num_features,
-            hidden_dim=config.hidden_dim_target,
-            num_classes=shadow_dataset.num_classes,
-            dropout=config.dropout,
-        )
+        if shadow_model is None:
+            shadow_model = utils.fresh_model(
+                model_type=config.model,
+                num_features=shadow_dataset.num_features,
+                hidden_dim=config.hidden_dim_target,
+                num_classes=shadow_dataset.num_classes,
+                dropout=config.dropout,
+                compile=config.compile,
+            )
+        else:
+            shadow_model.reset_parameters()
+        self.shadow_model = shadow_model
         dims = [shadow_dataset.num_classes, *config.hidden_dim_attack, 2]
         self.attack_model = MLP(channel_list=dims, dropout=0.0)
         self.shadow_dataset = shadow_dataset
@@ -39,7 +213,7 @@ class BasicShadowAttack:
     def train_shadow_model(self):
         config = self.config
         train_config = trainer.TrainConfig(
-            criterion=Accuracy(task="multiclass", num_classes=self.shadow_dataset.num_classes).to(config.device),
+            criterion=trainer.accuracy,
             device=config.device,
             epochs=config.epochs_target,
             early_stopping=config.early_stopping,
@@ -47,6 +221,8 @@ class BasicShadowAttack:
             lr=config.lr,
             weight_decay=config.weight_decay,
             optimizer=getattr(torch.optim, config.optimizer),
+            amp=config.amp,
+            amp_dtype=getattr(torch, config.amp_dtype),
         )
         train_res = trainer.train_gnn(
             model=self.shadow_model,
@@ -57,7 +233,7 @@ class BasicShadowAttack:
             model=self.shadow_model,
             dataset=self.shadow_dataset,
             criterion=train_config.criterion,
-            training_results=train_res if self.plot_training_results else None,
+            training_results=train_res if self.plot_training_results and config.make_plots else None,
             plot_title="Shadow model",
             savedir=config.savedir,
         )
@@ -65,10 +241,20 @@ class BasicShadowAttack:
     def train_attack_model(self):
         config = self.config
         train_dataset, valid_dataset = datasetup.create_attack_dataset(self.shadow_dataset, self.shadow_model)
-        train_loader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True)
-        valid_loader = DataLoader(valid_dataset, batch_size=config.batch_size, shuffle=False)
+        train_loader = datasetup.TensorLoader(
+            features=train_dataset.features.to(config.device),
+            labels=train_dataset.labels.to(config.device),
+            batch_size=config.batch_size,
+            shuffle=True,
+        )
+        valid_loader = datasetup.TensorLoader(
+            features=valid_dataset.features.to(config.device),
+            labels=valid_dataset.labels.to(config.device),
+            batch_size=config.batch_size,
+            shuffle=False,
+        )
         train_config = trainer.TrainConfig(
-            criterion=Accuracy(task="multiclass", num_classes=2).to(config.device),
+            criterion=trainer.accuracy,
             device=config.device,
             epochs=config.epochs_attack,
             early_stopping=config.early_stopping,
@@ -91,7 +277,7 @@ class BasicShadowAttack:
             preds = evaluation.k_hop_query(
                 model=self.target_model,
                 dataset=target_samples,
-                query_nodes=[*range(num_target_samples)],
+                query_nodes=torch.arange(num_target_samples),
                 num_hops=config.query_hops,
             )
             logits = self.attack_model(preds)[:,1]
@@ -112,11 +298,10 @@ class ConfidenceAttack:
             preds = evaluation.k_hop_query(
                 model=self.target_model,
                 dataset=target_samples,
-                query_nodes=[*range(num_target_samples)],
+                query_nodes=torch.arange(num_target_samples),
                 num_hops=config.query_hops,
             )
-            row_idx = np.arange(num_target_samples)
-            confidences = F.softmax(preds, dim=1)[row_idx, target_samples.y]
+            confidences = utils.true_label_confidence(preds, target_samples.y)
             labels = target_samples.train_mask.long()
         return evaluation.bc_evaluation(confidences, labels)
 
@@ -125,6 +310,7 @@ class LiRA:
     The likelihood ratio attack from "Membership Inference Attacks From First Principles"
     '''
     EPS = 1e-6
+    QUERY_BATCH_SIZE = 16 # Number of shadow models to query in each vectorized forward pass.
 
     def __init__(self, target_model, population, config, online=False):
         target_model.eval()
@@ -133,61 +319,57 @@ class LiRA:
         self.population = population # Should not contain target samples.
         self.config = config
         self.shadow_size = population.x.shape[0] // 2
+        self.shadow_statistics = None # (target_samples, k_hop_inputs, means, stds) of the last attack.
         self.train_shadow_models()
 
+    def set_target_model(self, target_model):
+        ''' Attack a new target model, reusing the trained shadow models. '''
+        target_model.eval()
+        self.target_model = target_model
+
     def train_shadow_models(self):
         config = self.config
-        criterion = Accuracy(task="multiclass", num_classes=self.population.num_classes).to(config.device)
-        train_config = trainer.TrainConfig(
-            criterion=criterion,
-            device=config.device,
-            epochs=config.epochs_target,
-            early_stopping=config.early_stopping,
-            loss_fn=F.cross_entropy,
-            lr=config.lr,
-            weight_decay=config.weight_decay,
-            optimizer=getattr(torch.optim, config.optimizer),
+        self.shadow_models = train_shadow_models(
+            population=self.population,
+            num_nodes=self.shadow_size,
+            config=config,
+            desc=f"Training {config.num_shadow_models} shadow models for LiRA",
         )
-        for _ in tqdm(range(config.num_shadow_models), desc=f"Training {config.num_shadow_models} shadow models for LiRA"):
-            shadow_dataset = datasetup.sample_subgraph(self.population, self.shadow_size)
-            shadow_model = utils.fresh_model(
-                model_type=config.model,
-                num_features=shadow_dataset.num_features,
-                hidden_dim=config.hidden_dim_target,
-                num_classes=shadow_dataset.num_classes,
-                dropout=config.dropout,
-            )
-            _ = trainer.train_gnn(
-                model=shadow_model,
-                dataset=shadow_dataset,
-                config=train_config,
-                use_tqdm=False,
-            )
-            self.shadow_models.append(shadow_model)
     
-    def get_mean_and_std(self, target_samples):
+    def get_mean_and_std(self, target_samples, k_hop_inputs=None):
         config = self.config
-        hinges = []
         num_target_samples = target_samples.x.shape[0]
-        desc=f"Computing confidence values from shadow models. {next(self.shadow_models[0].parameters()).device} device"
-        for shadow_model in tqdm(self.shadow_models, desc=desc):
-            shadow_model.eval()
+        if k_hop_inputs is None:
+            k_hop_inputs = evaluation.cached_k_hop_inputs(
+                dataset=target_samples,
+                query_nodes=torch.arange(num_target_samples),
+                num_hops=config.query_hops,
+            )
+        # Accumulate the statistics over batches of shadow models, so that only a batch of hinges is in memory.
+        moments = utils.RunningMoments()
+        first_sample_hinges = []
+        for i in range(0, len(self.shadow_models), LiRA.QUERY_BATCH_SIZE):
+            shadow_models = self.shadow_models[i: i + LiRA.QUERY_BATCH_SIZE]
             with torch.inference_mode():
-                preds = evaluation.k_hop_query(
-                    model=shadow_model,
+                preds = evaluation.multi_model_k_hop_query(
+                    models=shadow_models,
                     dataset=target_samples,
-                    query_nodes=[*range(num_target_samples)],
+                    query_nodes=torch.arange(num_target_samples),
                     num_hops=config.query_hops,
+                    k_hop_inputs=k_hop_inputs,
                 )
                 # Approximate logits of confidence values using the hinge loss.
-                hinges.append(utils.hinge_loss(preds, target_samples.y))
-        hinges = torch.stack(hinges)
-        assert hinges.shape == torch.Size([len(self.shadow_models), num_target_samples])
-        means = hinges.mean(dim=0)
-        stds = hinges.std(dim=0)
+                hinges = utils.hinge_loss(
+                    preds.flatten(end_dim=1),
+                    target_samples.y.repeat(len(shadow_models)),
+                ).view(len(shadow_models), num_target_samples)
+                moments.update(hinges)
+            first_sample_hinges.append(hinges[:,0])
+        means = moments.mean
+        stds = moments.std
         if config.experiments == 1:
             utils.plot_histogram_and_fitted_gaussian(
-                x=hinges[:,0].cpu().numpy(),
+                x=torch.cat(first_sample_hinges).cpu().numpy(),
                 mean=means[0].cpu().numpy(),
                 std=stds[0].cpu().numpy(),
                 bins=max(len(self.shadow_models) // 8, 1),
@@ -199,13 +381,26 @@ class LiRA:
         config = self.config
         target_samples.to(config.device)
         num_target_samples = target_samples.x.shape[0]
-        means, stds = self.get_mean_and_std(target_samples)
+        # The shadow model statistics do not depend on the target model or on the membership masks,
+        # so they are reused when attacking the same samples again.
+        if self.shadow_statistics is not None and self.shadow_statistics[0] is target_samples:
+            _, k_hop_inputs, means, stds = self.shadow_statistics
+        else:
+            # The target and shadow models are queried on the same neighborhoods, so extract them only once.
+            k_hop_inputs = evaluation.cached_k_hop_inputs(
+                dataset=target_samples,
+                query_nodes=torch.arange(num_target_samples),
+                num_hops=config.query_hops,
+            )
+            means, stds = self.get_mean_and_std(target_samples, k_hop_inputs=k_hop_inputs)
+            self.shadow_statistics = target_samples, k_hop_inputs, means, stds
         with torch.inference_mode():
             preds = evaluation.k_hop_query(
                 model=self.target_model,
                 dataset=target_samples,
-                query_nodes=[*range(num_target_samples)],
+                query_nodes=torch.arange(num_target_samples),
                 num_hops=config.query_hops,
+                k_hop_inputs=k_hop_inputs,
             )
             target_hinges = utils.hinge_loss(preds, target_samples.y)
 
@@ -213,12 +408,8 @@ class LiRA:
         # a normal distribution with mean and variance given by the shadow models confidences.
         # We normalize the target confidence and compute the test statistic Lambda' = P(Z < x), Z ~ Normal(0, 1)
         # For numerical stability, compute the log CDF.
-        preds = norm.logcdf(
-            target_hinges.cpu().numpy(),
-            loc=means.cpu().numpy(),
-            scale=stds.cpu().numpy() + LiRA.EPS,
-        )
-        truth = target_samples.train_mask.long().cpu().numpy()
+        preds = torch.special.log_ndtr((target_hinges - means) / (stds + LiRA.EPS))
+        truth = target_samples.train_mask.long()
         return evaluation.bc_evaluation(
             preds=preds,
             labels=truth,
@@ -229,6 +420,7 @@ class RMIA:
     The attack from "Low-Cost High-Power Membership Inference Attacks".
     Only the offline attack is currently supported.
     '''
+    QUERY_BATCH_SIZE = 16 # Number of out models to query in each vectorized forward pass.
 
     def __init__(self, target_model, population, config):
         target_model.eval()
@@ -239,65 +431,61 @@ class RMIA:
         self.out_size = self.population .x.shape[0] // 2
         self.gamma = 2 # Value used in the original paper
         self.interp_param = config.rmia_offline_interp_param
+        self.out_statistics = {} # id(dataset) -> (dataset, k_hop_inputs, pr)
         self.train_out_models()
 
+    def set_target_model(self, target_model):
+        ''' Attack a new target model, reusing the trained out models. '''
+        target_model.eval()
+        self.target_model = target_model
+
     def train_out_models(self):
         config = self.config
-        criterion = Accuracy(task="multiclass", num_classes=self.population.num_classes).to(config.device)
-        train_config = trainer.TrainConfig(
-            criterion=criterion,
-            device=config.device,
-            epochs=config.epochs_target,
-            early_stopping=config.early_stopping,
-            loss_fn=F.cross_entropy,
-            lr=config.lr,
-            weight_decay=config.weight_decay,
-            optimizer=getattr(torch.optim, config.optimizer),
+        self.out_models = train_shadow_models(
+            population=self.population,
+            num_nodes=self.out_size,
+            config=config,
+            desc=f"Training {config.num_shadow_models} out models for RMIA",
         )
-        for _ in tqdm(range(config.num_shadow_models), desc=f"Training {config.num_shadow_models} out models for RMIA"):
-            shadow_dataset = datasetup.sample_subgraph(self.population, self.out_size)
-            shadow_model = utils.fresh_model(
-                model_type=config.model,
-                num_features=shadow_dataset.num_features,
-                hidden_dim=config.hidden_dim_target,
-                num_classes=shadow_dataset.num_classes,
-                dropout=config.dropout,
-            )
-            _ = trainer.train_gnn(
-                model=shadow_model,
-                dataset=shadow_dataset,
-                config=train_config,
-                use_tqdm=False,
-            )
-            self.out_models.append(shadow_model)
 
     def ratio(self, dataset):
         config = self.config
         num_target_nodes = dataset.x.shape[0]
-        row_idx = np.arange(num_target_nodes)
-        out_confidences = []
-        for shadow_model in tqdm(self.out_models, desc=f"Querying out models. {next(self.out_models[0].parameters()).device} device"):
-            shadow_model.eval()
-            with torch.inference_mode():
-                preds = evaluation.k_hop_query(
-                    model=shadow_model,
-                    dataset=dataset,
-                    query_nodes=[*range(num_target_nodes)],
-                    num_hops=config.query_hops,
-                )
-                out_confidences.append(F.softmax(preds, dim=1)[row_idx, dataset.y])
-        out_confidences = torch.stack(out_confidences)
-        pr_out = out_confidences.mean(dim=0)
-        pr = 0.5 * ((self.interp_param + 1) * pr_out + 1 - self.interp_param) # Heuristic to approximate the average of in and out, from out only.
+        # The out model confidences do not depend on the target model, so they are computed once per dataset.
+        # The dataset itself is kept in the cache so that its id is not reused while the entry is alive.
+        if id(dataset) in self.out_statistics:
+            _, k_hop_inputs, pr = self.out_statistics[id(dataset)]
+        else:
+            k_hop_inputs = evaluation.cached_k_hop_inputs(
+                dataset=dataset,
+                query_nodes=torch.arange(num_target_nodes),
+                num_hops=config.query_hops,
+            )
+            # Sum the confidences over batches of out models, so that only a batch of predictions is in memory.
+            confidence_sum = torch.zeros(num_target_nodes, device=dataset.x.device)
+            for i in range(0, len(self.out_models), RMIA.QUERY_BATCH_SIZE):
+                with torch.inference_mode():
+                    preds = evaluation.multi_model_k_hop_query(
+                        models=self.out_models[i: i + RMIA.QUERY_BATCH_SIZE],
+                        dataset=dataset,
+                        query_nodes=torch.arange(num_target_nodes),
+                        num_hops=config.query_hops,
+                        k_hop_inputs=k_hop_inputs,
+                    )
+                    confidence_sum += utils.true_label_confidence(preds, dataset.y).sum(dim=0)
+            pr_out = confidence_sum / len(self.out_models)
+            pr = 0.5 * ((self.interp_param + 1) * pr_out + 1 - self.interp_param) # Heuristic to approximate the average of in and out, from out only.
+            self.out_statistics[id(dataset)] = dataset, k_hop_inputs, pr
 
         with torch.inference_mode():
             preds = evaluation.k_hop_query(
                 model=self.target_model,
                 dataset=dataset,
-                query_nodes=[*range(num_target_nodes)],
+                query_nodes=torch.arange(num_target_nodes),
                 num_hops=config.query_hops,
+                k_hop_inputs=k_hop_inputs,
             )
-            target_confidence = F.softmax(preds, dim=1)[row_idx, dataset.y] 
+            target_confidence = utils.true_label_confidence(preds, dataset.y)
         assert pr.shape == target_confidence.shape == torch.Size([num_target_nodes])
         return target_confidence / pr
 
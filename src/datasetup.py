@@ -1,8 +1,12 @@
+import numpy as np
+import scipy.sparse as sp
 import torch
 import torch_geometric
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 from torch_geometric.data import Data
-from torch_geometric.utils import index_to_mask, subgraph
+from torch_geometric.utils import index_to_mask, sort_edge_index, subgraph
 from sklearn.model_selection import train_test_split
+from pathlib import Path
 
 
 class AttackDataset(torch.utils.data.Dataset):
@@ -19,14 +23,63 @@ class AttackDataset(torch.utils.data.Dataset):
         label = self.labels[idx]
         return feature, label
 
+class TensorLoader:
+    '''
+    Minimal replacement of DataLoader for datasets that fit in device memory as two tensors.
+    Mini-batches are sliced directly from the tensors, without per-sample indexing and collation.
+    '''
+
+    def __init__(self, features, labels, batch_size, shuffle=False):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        num_samples = len(self.labels)
+        if self.shuffle:
+            index = torch.randperm(num_samples, device=self.labels.device)
+            for i in range(0, num_samples, self.batch_size):
+                batch = index[i: i + self.batch_size]
+                yield self.features[batch], self.labels[batch]
+        else:
+            for i in range(0, num_samples, self.batch_size):
+                yield self.features[i: i + self.batch_size], self.labels[i: i + self.batch_size]
+
 def create_attack_dataset(shadow_dataset, shadow_model):
-    features = shadow_model(shadow_dataset.x, shadow_dataset.edge_index).cpu()
+    with torch.no_grad():
+        features = shadow_model(shadow_dataset.x, shadow_dataset.edge_index).cpu()
     labels = shadow_dataset.train_mask.long().cpu()
     train_X, test_X, train_y, test_y = train_test_split(features, labels, test_size=0.2, stratify=labels)
     train_dataset = AttackDataset(train_X, train_y)
     test_dataset = AttackDataset(test_X, test_y)
     return train_dataset, test_dataset
 
+def random_masks(num_nodes, train_frac=0.5, val_frac=0.2, device=None):
+    ''' Masks for training/validation/testing, constructed uniformly random with the specified proportions. '''
+    num_train_nodes = int(train_frac * num_nodes)
+    num_val_nodes = int(val_frac * num_nodes)
+    randomized_index = torch.randperm(num_nodes, device=device)
+    train_index = randomized_index[:num_train_nodes]
+    val_index = randomized_index[num_train_nodes: num_train_nodes + num_val_nodes]
+    test_index = randomized_index[num_train_nodes + num_val_nodes:]
+    train_mask = index_to_mask(train_index, num_nodes)
+    val_mask = index_to_mask(val_index, num_nodes)
+    test_mask = index_to_mask(test_index, num_nodes)
+    return train_mask, val_mask, test_mask
+
+def resample_masks(dataset, train_frac=0.5, val_frac=0.2):
+    ''' Redraws the training/validation/testing masks of the graph dataset in place. '''
+    dataset.train_mask, dataset.val_mask, dataset.test_mask = random_masks(
+        dataset.x.shape[0],
+        train_frac=train_frac,
+        val_frac=val_frac,
+        device=dataset.x.device,
+    )
+
 def extract_subgraph(dataset, node_index, train_frac=0.5, val_frac=0.2):
     '''
     Constructs a subgraph of dataset consisting of the nodes indexed in node_index with the edges linking them.
@@ -38,16 +91,12 @@ def extract_subgraph(dataset, node_index, train_frac=0.5, val_frac=0.2):
         relabel_nodes=True,
         num_nodes=dataset.x.shape[0],
     )
-    num_nodes = len(node_index)
-    num_train_nodes = int(train_frac * num_nodes)
-    num_val_nodes = int(val_frac * num_nodes)
-    randomized_index = torch.randperm(num_nodes)
-    train_index = randomized_index[:num_train_nodes]
-    val_index = randomized_index[num_train_nodes: num_train_nodes + num_val_nodes]
-    test_index = randomized_index[num_train_nodes + num_val_nodes:]
-    train_mask = index_to_mask(train_index, num_nodes)
-    val_mask = index_to_mask(val_index, num_nodes)
-    test_mask = index_to_mask(test_index, num_nodes)
+    train_mask, val_mask, test_mask = random_masks(
+        len(node_index),
+        train_frac=train_frac,
+        val_frac=val_frac,
+        device=node_index.device,
+    )
     return Data(
         x=dataset.x[node_index],
         edge_index=edge_index,
@@ -60,6 +109,23 @@ def extract_subgraph(dataset, node_index, train_frac=0.5, val_frac=0.2):
         name=dataset.name,
     )
 
+def stratified_node_split(dataset, frac):
+    '''
+    Randomly split the nodes of the graph dataset in two parts, where the first part
+    gets the fraction frac of the nodes of each class and the second part gets the remaining nodes.
+    '''
+    y = dataset.y
+    num_nodes = y.shape[0]
+    randomized_index = torch.randperm(num_nodes, device=y.device)
+    # A stable sort by class keeps the random order of the nodes within each class.
+    order = randomized_index[torch.sort(y[randomized_index], stable=True).indices]
+    class_counts = torch.bincount(y, minlength=dataset.num_classes)
+    class_offsets = torch.cumsum(class_counts, dim=0) - class_counts
+    rank_in_class = torch.arange(num_nodes, device=y.device) - class_offsets[y[order]]
+    in_first_part = rank_in_class < (class_counts.double() * frac).long()[y[order]]
+    # Sorted node indices preserve the memory locality of the node ordering in the extracted subgraphs.
+    return order[in_first_part].sort().values, order[~in_first_part].sort().values
+
 def sample_subgraph(dataset, num_nodes, train_frac=0.5, val_frac=0.2, keep_class_proportions=True):
     '''
     Sample a subgraph by uniformly sample a number of nodes from the graph dataset.
@@ -69,17 +135,10 @@ def sample_subgraph(dataset, num_nodes, train_frac=0.5, val_frac=0.2, keep_class
     '''
     total_num_nodes = dataset.x.shape[0]
     assert 0 < num_nodes <= total_num_nodes
-    node_frac = num_nodes / total_num_nodes
-    randomized_index = torch.randperm(total_num_nodes)
     if keep_class_proportions:
-        node_index = []
-        for c in range(dataset.num_classes):
-            idx = (dataset.y[randomized_index] == c).nonzero().squeeze(dim=1)
-            n = int(len(idx) * node_frac)
-            node_index.append(idx[:n])
-        node_index = torch.cat(node_index)
+        node_index, _ = stratified_node_split(dataset, num_nodes / total_num_nodes)
     else:
-        node_index = randomized_index[:num_nodes]
+        node_index = torch.randperm(total_num_nodes, device=dataset.x.device)[:num_nodes]
     return extract_subgraph(dataset, node_index, train_frac=train_frac, val_frac=val_frac)
 
 def disjoint_split(dataset, balance=0.5):
@@ -87,18 +146,7 @@ def disjoint_split(dataset, balance=0.5):
     Split the graph dataset in two disjoint subgraphs.
     The balance the fraction of nodes to use for the first subgraph, and the second subgraph gets the remaining nodes.
     '''
-    node_index_A = []
-    node_index_B = []
-    num_nodes = dataset.x.shape[0]
-    randomized_index = torch.randperm(num_nodes)
-    for c in range(dataset.num_classes):
-        idx = (dataset.y[randomized_index] == c).nonzero().squeeze(dim=1)
-        n = int(len(idx) * balance)
-        node_index_A.append(idx[:n])
-        node_index_B.append(idx[n:])
-    node_index_A = torch.cat(node_index_A)
-    node_index_B = torch.cat(node_index_B)
-    return node_index_A, node_index_B
+    return stratified_node_split(dataset, balance)
 
 def target_shadow_split(dataset, split="sampled", target_frac=0.5, shadow_frac=0.5):
     num_nodes = dataset.x.shape[0]
@@ -136,3 +184,53 @@ def parse_dataset(root, name):
         case _:
             raise ValueError("Unsupported dataset!")
     return dataset
+
+def reorder_graph(dataset):
+    '''
+    Relabel the nodes of the graph in reverse Cuthill-McKee order, which places adjacent nodes close together.
+    This improves the memory locality of the neighborhood gathers in message passing.
+    '''
+    data = dataset[0]
+    num_nodes = data.x.shape[0]
+    row, col = data.edge_index.cpu().numpy()
+    adj = sp.csr_matrix((np.ones_like(row), (row, col)), shape=(num_nodes, num_nodes))
+    perm = torch.from_numpy(reverse_cuthill_mckee(adj, symmetric_mode=False).astype(np.int64))
+    new_index = torch.empty_like(perm)
+    new_index[perm] = torch.arange(num_nodes)
+    masks = {key: data[key][perm] for key in ('train_mask', 'val_mask', 'test_mask') if key in data}
+    return Data(
+        x=data.x[perm],
+        edge_index=sort_edge_index(new_index[data.edge_index], num_nodes=num_nodes),
+        y=data.y[perm],
+        num_classes=dataset.num_classes,
+        num_features=dataset.num_features,
+        name=dataset.name,
+        **masks,
+    )
+
+def load_dataset(root, name):
+    '''
+    Parse and reorder the dataset, caching the result in root. The cache is memory-mapped when loaded,
+    so the feature matrix is paged in on demand instead of being deserialized up front.
+    '''
+    cache = Path(root) / f'{name}_parsed.pt'
+    if cache.exists():
+        return torch.load(cache, mmap=True, map_location='cpu', weights_only=False)
+    dataset = reorder_graph(parse_dataset(root=root, name=name))
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(dataset, cache)
+    return dataset
+
+def compress_features(dataset, feature_dtype='auto'):
+    '''
+    Store the node features in a narrower dtype to cut their memory footprint and transfer bandwidth.
+    With 'auto', binary (bag-of-words) features are stored losslessly as uint8 and other features are kept as is.
+    The models cast the features back to float on entry.
+    '''
+    x = dataset.x
+    if feature_dtype == 'auto':
+        if x.is_floating_point() and ((x == 0) | (x == 1)).all():
+            dataset.x = x.to(torch.uint8)
+    else:
+        dataset.x = x.to(getattr(torch, feature_dtype))
+    return dataset
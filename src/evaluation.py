@@ -1,63 +1,174 @@
 import utils
 
 import torch
+from copy import deepcopy
 from torch_geometric.utils import k_hop_subgraph, subgraph, mask_to_index
-from sklearn.metrics import roc_curve, roc_auc_score
+
+def roc_curve(preds, labels):
+    '''
+    ROC curve of binary predictions, computed on the device of the predictions.
+    Like sklearn.metrics.roc_curve, there is one point per distinct score, and points on straight segments are dropped.
+    '''
+    order = torch.argsort(preds, descending=True)
+    preds, labels = preds[order], labels[order].double()
+    # The last position of each run of tied scores is a threshold.
+    threshold_index = torch.nonzero(preds[1:] != preds[:-1]).view(-1)
+    threshold_index = torch.cat([threshold_index, threshold_index.new_tensor([preds.shape[0] - 1])])
+    tps = torch.cumsum(labels, dim=0)[threshold_index]
+    fps = threshold_index + 1 - tps
+    if tps.shape[0] > 2:
+        keep = torch.ones_like(tps, dtype=torch.bool)
+        keep[1:-1] = (fps.diff(n=2) != 0) | (tps.diff(n=2) != 0)
+        tps, fps = tps[keep], fps[keep]
+    tps = torch.cat([tps.new_zeros(1), tps])
+    fps = torch.cat([fps.new_zeros(1), fps])
+    return fps / fps[-1], tps / tps[-1]
 
 def bc_evaluation(preds, labels):
-    if torch.is_tensor(preds):
-        preds = preds.cpu().numpy()
-    if torch.is_tensor(labels):
-        labels = labels.cpu().numpy()
-    auroc = roc_auc_score(y_true=labels, y_score=preds)
-    fpr, tpr, _ = roc_curve(y_true=labels, y_score=preds)
+    ''' AUROC and ROC curve of a binary classification. The curve is returned as host arrays for plotting and saving. '''
+    preds = torch.as_tensor(preds)
+    labels = torch.as_tensor(labels, device=preds.device)
+    fpr, tpr = roc_curve(preds.view(-1), labels.view(-1))
+    auroc = torch.trapezoid(tpr, fpr).item()
     return {
         'auroc': auroc,
-        'roc': (fpr, tpr),
+        'roc': (fpr.cpu().numpy(), tpr.cpu().numpy()),
     }
 
-def k_hop_query(model, dataset, query_nodes, num_hops=0, use_ideal_neighborhood=False):
+def cached_k_hop_inputs(dataset, query_nodes, num_hops=0, use_ideal_neighborhood=False):
+    '''
+    Extracts the "num_hops"-hop neighborhood of each node in query_nodes, so that the extraction
+    can be shared between several models queried on the same nodes.
+    The neighborhoods are relabeled and stacked as one graph with a connected component per query node.
+    When use_ideal_neighborhood flag is set, the local k-hop query is restricted to
+    the nodes having the same training membership status as the center node.
+
+    Output: Tuple (x_sub, edge_index_sub, node_mapping), where node_mapping holds the
+            position of each query node in x_sub.
+    '''
+    if not torch.is_tensor(query_nodes):
+        query_nodes = torch.tensor(query_nodes, dtype=torch.int64)
+    if num_hops == 0:
+        # Without neighborhoods there is nothing to extract, each query node is an isolated node.
+        device = dataset.x.device
+        x_sub = dataset.x[query_nodes.to(device)]
+        edge_index_sub = torch.empty((2, 0), dtype=torch.int64, device=device)
+        node_mapping = torch.arange(len(query_nodes), device=device)
+        return x_sub, edge_index_sub, node_mapping
+    num_nodes = dataset.x.shape[0]
+    if use_ideal_neighborhood:
+        member_edge_index, _ = subgraph(
+            subset=mask_to_index(dataset.train_mask),
+            edge_index=dataset.edge_index,
+            num_nodes=num_nodes,
+        )
+        non_member_edge_index, _ = subgraph(
+            subset=mask_to_index(~dataset.train_mask),
+            edge_index=dataset.edge_index,
+            num_nodes=num_nodes,
+        )
+    node_indices, edge_indices, node_mapping = [], [], []
+    offset = 0
+    for v in query_nodes:
+        if use_ideal_neighborhood:
+            edge_index = member_edge_index if dataset.train_mask[v] else non_member_edge_index
+        else:
+            edge_index = dataset.edge_index
+        node_index, edge_index, v_idx, _ = k_hop_subgraph(
+            node_idx=v.item(),
+            num_hops=num_hops,
+            edge_index=edge_index,
+            relabel_nodes=True,
+            num_nodes=num_nodes,
+        )
+        node_indices.append(node_index)
+        edge_indices.append(edge_index + offset)
+        node_mapping.append(v_idx + offset)
+        offset += node_index.shape[0]
+    x_sub = dataset.x[torch.cat(node_indices)]
+    return x_sub, torch.cat(edge_indices, dim=1), torch.cat(node_mapping)
+
+def k_hop_query(model, dataset, query_nodes, num_hops=0, use_ideal_neighborhood=False, k_hop_inputs=None):
     '''
     Queries the model for each node in in query_nodes,
     using the local subgraph definded by the "num_hops"-hop neigborhood.
     When use_ideal_neighborhood flag is set, the local k-hop query is restricted to
     the nodes having the same training membership status as the center node.
+    The neighborhoods can be precomputed with cached_k_hop_inputs and passed as k_hop_inputs.
 
     Output: Matrix of size "number of query nodes" times "number of classes",
             consisting of logits/predictions for each query node.
     '''
     model.eval()
-    if not torch.is_tensor(query_nodes):
-        query_nodes = torch.tensor(query_nodes, dtype=torch.int64)
-    if num_hops == 0:
-        with torch.inference_mode():
-            predictions = model(dataset.x[query_nodes], torch.tensor([[],[]], dtype=torch.int64))
-    else:
-        # Can we speed this up?
-        predictions = []
-        for v in query_nodes:
-            if use_ideal_neighborhood:
-                mask = dataset.train_mask if dataset.train_mask[v] else ~dataset.train_mask
-                edge_index, _ = subgraph(
-                    subset=mask_to_index(mask),
-                    edge_index=dataset.edge_index,
-                    num_nodes=dataset.x.shape[0]
-                )
-            else:
-                edge_index = dataset.edge_index
-            node_index, edge_index, v_idx, _ = k_hop_subgraph(
-                node_idx=v.item(),
-                num_hops=num_hops,
-                edge_index=edge_index,
-                relabel_nodes=True,
-                num_nodes=dataset.x.shape[0],
-            )
-            pred = model(dataset.x[node_index], edge_index)[v_idx].squeeze()
-            predictions.append(pred)
-        predictions = torch.stack(predictions)
+    if k_hop_inputs is None:
+        k_hop_inputs = cached_k_hop_inputs(
+            dataset=dataset,
+            query_nodes=query_nodes,
+            num_hops=num_hops,
+            use_ideal_neighborhood=use_ideal_neighborhood,
+        )
+    x_sub, edge_index_sub, node_mapping = k_hop_inputs
+    with torch.inference_mode():
+        # The neighborhoods are disjoint components, so a single forward pass answers all queries.
+        predictions = model(x_sub, edge_index_sub)[node_mapping]
     assert predictions.shape == torch.Size([len(query_nodes), dataset.num_classes])
     return predictions
 
+vmap_unsupported_models = set() # Model classes that failed under torch.vmap, so that it is not retried for them.
+
+def is_vmap_unsupported(error):
+    ''' Whether the error was raised by an operation lacking support for torch.vmap. '''
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return False
+    message = str(error).lower()
+    return isinstance(error, NotImplementedError) or 'batching rule' in message or 'vmap' in message
+
+def multi_model_k_hop_query(models, dataset, query_nodes, num_hops=0, k_hop_inputs=None):
+    '''
+    Queries several models with identical architecture on the same k-hop neighborhoods.
+    The parameters of the models are stacked and evaluated in a single vectorized forward pass.
+    Falls back to querying the models one by one if some layer lacks support for torch.vmap.
+
+    Output: Tensor of size "number of models" times "number of query nodes" times "number of classes".
+    '''
+    if k_hop_inputs is None:
+        k_hop_inputs = cached_k_hop_inputs(dataset=dataset, query_nodes=query_nodes, num_hops=num_hops)
+    x_sub, edge_index_sub, node_mapping = k_hop_inputs
+    for model in models:
+        model.eval()
+    model_type = type(models[0])
+    predictions = None
+    if model_type not in vmap_unsupported_models:
+        params, buffers = torch.func.stack_module_state(models)
+        base_model = deepcopy(models[0]).to('meta')
+
+        def functional_model(params, buffers, x, edge_index):
+            return torch.func.functional_call(base_model, (params, buffers), (x, edge_index))
+
+        try:
+            with torch.inference_mode():
+                predictions = torch.vmap(functional_model, in_dims=(0, 0, None, None))(
+                    params, buffers, x_sub, edge_index_sub
+                )[:, node_mapping]
+        except (RuntimeError, NotImplementedError) as e:
+            # Only fall back when some operation lacks vmap support, other errors such as running out of memory are raised.
+            if not is_vmap_unsupported(e):
+                raise
+            vmap_unsupported_models.add(model_type)
+            print(f'Vectorized queries of {model_type.__name__} are not supported, querying the models one by one: {e}')
+    if predictions is None:
+        predictions = torch.stack([
+            k_hop_query(
+                model=model,
+                dataset=dataset,
+                query_nodes=query_nodes,
+                num_hops=num_hops,
+                k_hop_inputs=k_hop_inputs,
+            ) for model in models
+        ])
+    assert predictions.shape == torch.Size([len(models), len(query_nodes), dataset.num_classes])
+    return predictions
+
 def evaluate_graph_model(model, dataset, mask, criterion):
     model.eval()
     with torch.inference_mode():
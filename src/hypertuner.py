@@ -7,9 +7,9 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch_geometric.data import Data
-from torchmetrics import Accuracy
 from tqdm.auto import tqdm
 from itertools import product
+from dataclasses import replace
 import matplotlib.pyplot as plt
 
 def grid_search(
@@ -21,7 +21,7 @@ def grid_search(
     hidden_dim: int,
 ):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    criterion = Accuracy(task="multiclass", num_classes=dataset.num_classes).to(device)
+    criterion = trainer.accuracy
     grid = {
         'lr': [5e-4, 1e-3, 5e-3, 1e-2],
         'weight_decay': [1e-5, 5e-5, 1e-4, 5e-4],
@@ -69,11 +69,11 @@ def rmia_offline_interp_param_search(
     model_type: str,
     datadir: str,
 ):
-    dataset = datasetup.parse_dataset(root=datadir, name=dataset)
+    dataset = datasetup.load_dataset(root=datadir, name=dataset)
     target_samples, population = datasetup.target_shadow_split(dataset=dataset, split='disjoint', target_frac=0.5, shadow_frac=0.5)
     
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    config = utils.Config({
+    config = utils.Config.from_dict({
         'device': device,
         'dataset': dataset,
         'datadir': datadir,
@@ -95,7 +95,7 @@ def rmia_offline_interp_param_search(
         num_classes=dataset.num_classes,
         dropout=config.dropout,
     )
-    criterion = Accuracy(task="multiclass", num_classes=dataset.num_classes).to(device)
+    criterion = trainer.accuracy
     train_config = trainer.TrainConfig(
         criterion=criterion,
         device=device,
@@ -117,7 +117,7 @@ def rmia_offline_interp_param_search(
     aurocs = []
     param_pool = np.arange(0.0, 1.0, 0.1)
     for interp_param in param_pool:
-        config.rmia_offline_interp_param = interp_param
+        config = replace(config, rmia_offline_interp_param=interp_param)
         auroc = attacks.RMIA(
             target_model=target_model,
             population=population,
@@ -127,6 +127,7 @@ def rmia_offline_interp_param_search(
         if auroc > best_auroc:
             best_auroc = auroc
             opt_interp_param = interp_param
+    utils.reused_figure()
     plt.plot(param_pool, aurocs)
     plt.show()
     return opt_interp_param
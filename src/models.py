@@ -1,11 +1,116 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch_geometric.nn as gnn
-from torch_geometric.utils import add_self_loops
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.utils import add_self_loops, degree
 from torch_scatter import scatter
+from collections import OrderedDict
+from threading import Lock
+
+LLC_BYTES = 32 * 2**20 # Assumed last level cache size, used to size the segments of the CSR segmented propagation.
+
+class PropagationCache:
+    '''
+    Small LRU cache of graph preprocessing, such as feature propagations, keyed on the identity of the
+    feature and edge tensors. Entries keep references to their key tensors, so a new tensor is never
+    mistaken for a cached one.
+    '''
+
+    def __init__(self, propagate, maxsize=4):
+        self.propagate = propagate
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __call__(self, x, edge_index, *args):
+        key = (id(x), id(edge_index), *args)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[-1]
+        # Computed outside of inference mode, so that cached propagations can be reused for training,
+        # and in full precision, so that a value first computed under autocast can be reused without it.
+        with torch.inference_mode(False), torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+            value = self.propagate(x, edge_index, *args)
+        with self.lock:
+            self.entries[key] = (x, edge_index, value)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+def gcn_normalize(x, edge_index):
+    ''' Edge weights of the symmetrically normalized adjacency matrix with self loops, as used by GCNConv. '''
+    return gcn_norm(edge_index, num_nodes=x.shape[0], dtype=torch.float)
+
+def sgc_propagate(x, edge_index, K):
+    ''' Computes (D^-1/2 (A + I) D^-1/2)^K x, as done by SGConv before its linear layer. '''
+    x = x.float()
+    edge_index, edge_weight = gcn_norm(edge_index, num_nodes=x.shape[0], dtype=x.dtype)
+    for _ in range(K):
+        x = scatter(x[edge_index[0]] * edge_weight.view(-1, 1), edge_index[1], dim=0, dim_size=x.shape[0], reduce='sum')
+    return x
+
+def mean_adjacency(edge_index, num_nodes, dtype=None):
+    ''' Row-normalized adjacency matrix with self loops, as a coalesced sparse COO tensor. '''
+    edge_index, _ = add_self_loops(edge_index, num_nodes=num_nodes)
+    row = edge_index[0]
+    inv_deg = degree(row, num_nodes=num_nodes, dtype=dtype).pow(-1)
+    return torch.sparse_coo_tensor(edge_index, inv_deg[row], size=(num_nodes, num_nodes)).coalesce()
+
+def csr_segments(adj, seg_size):
+    '''
+    Splits the columns of a coalesced sparse COO matrix into CSR blocks of at most seg_size columns (CSR segmenting).
+    Multiplying one block at a time confines the random reads of the dense operand to a cache-sized segment.
+    '''
+    row, col = adj.indices()
+    value = adj.values()
+    num_rows, num_cols = adj.shape
+    segments = []
+    for start in range(0, num_cols, seg_size):
+        end = min(start + seg_size, num_cols)
+        mask = (col >= start) & (col < end)
+        block = torch.sparse_coo_tensor(
+            torch.stack([row[mask], col[mask] - start]),
+            value[mask],
+            size=(num_rows, end - start),
+        )
+        segments.append((start, end, block.coalesce().to_sparse_csr()))
+    return segments
+
+def csr_segmented_spmm(segments, x):
+    ''' Computes adj @ x from the CSR segments of adj, accumulating the partial products. '''
+    out = None
+    for start, end, block in segments:
+        partial = block @ x[start:end]
+        out = partial if out is None else out + partial
+    return out
+
+def mean_propagate(x, edge_index, num_propagations):
+    ''' Averages the features over the neighborhood (including self loops) num_propagations times. '''
+    x = x.float()
+    adj = mean_adjacency(edge_index, num_nodes=x.shape[0], dtype=x.dtype)
+    seg_size = max(1, LLC_BYTES // (x.shape[1] * x.element_size()))
+    segments = csr_segments(adj, seg_size)
+    for _ in range(num_propagations):
+        x = csr_segmented_spmm(segments, x)
+    return x
+
+class GCNConv(gnn.GCNConv):
+    ''' A single graph convolution, with the same constructor signature as the other models. '''
+
+    def __init__(self, in_dim, hidden_dim, out_dim, dropout=0.0):
+        super(GCNConv, self).__init__(in_channels=in_dim, out_channels=out_dim)
+
+    def forward(self, x, edge_index):
+        return super(GCNConv, self).forward(x.float(), edge_index)
 
 class TwoLayerGNN(nn.Module):
-    ''' Base class for the different GNN architectures to inherit common implementations from. '''
+    '''
+    Base class for the different GNN architectures to inherit common implementations from.
+    The node features may be stored in a narrow dtype (see datasetup.compress_features) and are cast to float on entry.
+    '''
 
     def __init__(self, dropout=0.0):
         super(TwoLayerGNN, self).__init__()
@@ -16,7 +121,7 @@ class TwoLayerGNN(nn.Module):
         self.conv2.reset_parameters()
 
     def forward(self, x, edge_index):
-        x = self.conv1(x, edge_index)
+        x = self.conv1(x.float(), edge_index)
         x = F.relu(x)
         x = F.dropout(input=x, p=self.dropout, training=self.training)
         x = self.conv2(x, edge_index)
@@ -26,8 +131,19 @@ class GCN(TwoLayerGNN):
 
     def __init__(self, in_dim, hidden_dim, out_dim, dropout=0.0):
         super(GCN, self).__init__(dropout=dropout)
-        self.conv1 = gnn.GCNConv(in_dim, hidden_dim)
-        self.conv2 = gnn.GCNConv(hidden_dim, out_dim)
+        self.conv1 = gnn.GCNConv(in_dim, hidden_dim, normalize=False, add_self_loops=False)
+        self.conv2 = gnn.GCNConv(hidden_dim, out_dim, normalize=False, add_self_loops=False)
+
+    # The normalization only depends on the graph, so it is computed once and shared by both layers and all models.
+    normalization_cache = PropagationCache(gcn_normalize)
+
+    def forward(self, x, edge_index):
+        edge_index, edge_weight = GCN.normalization_cache(x, edge_index)
+        x = self.conv1(x.float(), edge_index, edge_weight)
+        x = F.relu(x)
+        x = F.dropout(input=x, p=self.dropout, training=self.training)
+        x = self.conv2(x, edge_index, edge_weight)
+        return x
 
 class SGC(TwoLayerGNN):
 
@@ -36,6 +152,17 @@ class SGC(TwoLayerGNN):
         self.conv1 = gnn.SGConv(in_dim, hidden_dim, K=2, cached=False)
         self.conv2 = gnn.SGConv(hidden_dim, out_dim, K=2, cached=False)
 
+    # The propagation in the first layer only depends on the input graph, so it is shared between
+    # forward passes and models. SGConv(cached=True) can not be used since the models are queried on other graphs.
+    propagation_cache = PropagationCache(sgc_propagate)
+
+    def forward(self, x, edge_index):
+        x = self.conv1.lin(SGC.propagation_cache(x, edge_index, self.conv1.K))
+        x = F.relu(x)
+        x = F.dropout(input=x, p=self.dropout, training=self.training)
+        x = self.conv2(x, edge_index)
+        return x
+
 class GraphSAGE(TwoLayerGNN):
 
     def __init__(self, in_dim, hidden_dim, out_dim, dropout=0.0):
@@ -70,11 +197,13 @@ class DecoupledGCN(nn.Module):
             dropout=dropout,
         )
 
+    def reset_parameters(self):
+        self.mlp.reset_parameters()
+
+    # The MLP is a single linear layer, which commutes with the (row-stochastic) propagation.
+    # Propagating the input features first makes the propagation cacheable across forward passes and models.
+    propagation_cache = PropagationCache(mean_propagate)
+
     def forward(self, x, edge_index):
-        x = self.mlp(x)
-        edge_index, _ = add_self_loops(edge_index, num_nodes=x.shape[0])
-        for _ in range(self.num_propagations - 1):
-            x = x[edge_index[1]]
-            x = scatter(x, edge_index[0], dim=0, reduce='mean')
-        x = scatter(x[edge_index[1]], edge_index[0], dim=0, reduce='mean')
-        return x
+        x = DecoupledGCN.propagation_cache(x, edge_index, self.num_propagations)
+        return self.mlp(x)
@@ -6,19 +6,24 @@ import trainer
 import utils
 
 import argparse
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn.functional as F
-from torchmetrics import Accuracy
-from statistics import mean, stdev
 import shutil
 
 class MembershipInferenceExperiment:
 
     def __init__(self, config):
-        self.config = utils.Config(config)
-        self.dataset = datasetup.parse_dataset(root=self.config.datadir, name=self.config.dataset)
-        self.criterion = Accuracy(task="multiclass", num_classes=self.dataset.num_classes).to(self.config.device)
+        self.config = utils.Config.from_dict(config)
+        self.dataset = datasetup.compress_features(
+            datasetup.load_dataset(root=self.config.datadir, name=self.config.dataset),
+            feature_dtype=self.config.feature_dtype,
+        )
+        # Move the graph to the device once, all target/shadow subgraphs are then extracted on the device.
+        self.dataset.to(self.config.device)
+        self.criterion = trainer.accuracy
+        self.target_model = None
         print(utils.GraphInfo(self.dataset))
 
     def visualize_embedding_distribution(self):
@@ -73,13 +78,19 @@ class MembershipInferenceExperiment:
         else:
             lr, weight_decay, dropout = config.lr, config.weight_decay, config.dropout
 
-        target_model = utils.fresh_model(
-            model_type=self.config.model,
-            num_features=dataset.num_features,
-            hidden_dim=self.config.hidden_dim_target,
-            num_classes=dataset.num_classes,
-            dropout=dropout,
-        )
+        if self.target_model is None or self.config.grid_search:
+            # The grid search may pick another dropout rate, otherwise the model is only re-initialized.
+            self.target_model = utils.fresh_model(
+                model_type=self.config.model,
+                num_features=dataset.num_features,
+                hidden_dim=self.config.hidden_dim_target,
+                num_classes=dataset.num_classes,
+                dropout=dropout,
+                compile=self.config.compile,
+            )
+        else:
+            self.target_model.reset_parameters()
+        target_model = self.target_model
 
         train_config = trainer.TrainConfig(
             criterion=self.criterion,
@@ -90,6 +101,8 @@ class MembershipInferenceExperiment:
             lr=lr,
             weight_decay=weight_decay,
             optimizer=getattr(torch.optim, config.optimizer),
+            amp=config.amp,
+            amp_dtype=getattr(torch, config.amp_dtype),
         )
         train_res = trainer.train_gnn(
             model=target_model,
@@ -100,7 +113,7 @@ class MembershipInferenceExperiment:
             model=target_model,
             dataset=dataset,
             criterion=train_config.criterion,
-            training_results=train_res if plot_training_results else None,
+            training_results=train_res if plot_training_results and config.make_plots else None,
             plot_title="Target model",
             savedir=config.savedir,
         )
@@ -109,21 +122,30 @@ class MembershipInferenceExperiment:
     def run(self):
         config = self.config
         dataset = self.dataset
-        train_scores, test_scores = [], []
-        aurocs = []
+        train_scores = np.empty(config.experiments)
+        test_scores = np.empty(config.experiments)
+        aurocs = np.empty(config.experiments)
         best_auroc = 0
-        fprs, tprs = [], []
+        fprs, tprs = [None] * config.experiments, [None] * config.experiments
+        shadow_model = None
+        attack = None
         for i in range(config.experiments):
             print(f'Running experiment {i + 1}/{config.experiments}.')
+            # Seed every experiment, so that an experiment does not depend on the random numbers drawn
+            # by the previous ones, which are skipped when the shadow models are loaded from the cache.
+            torch.manual_seed(config.seed + i)
 
             if config.attack == "basic-shadow":
                 target_dataset, shadow_dataset = datasetup.target_shadow_split(dataset, split=config.split)
                 target_model = self.train_target_model(target_dataset)
-                metrics = attacks.BasicShadowAttack(
+                attack = attacks.BasicShadowAttack(
                     target_model=target_model,
                     shadow_dataset=shadow_dataset,
                     config=config,
-                ).run_attack(target_samples=target_dataset)
+                    shadow_model=shadow_model,
+                )
+                shadow_model = attack.shadow_model
+                metrics = attack.run_attack(target_samples=target_dataset)
 
             elif config.attack == "confidence":
                 target_dataset = datasetup.sample_subgraph(dataset, num_nodes=dataset.x.shape[0]//2)
@@ -133,25 +155,26 @@ class MembershipInferenceExperiment:
                     config=config,
                 ).run_attack(target_samples=target_dataset)
 
-            elif config.attack == "lira":
-                # In offline LiRA, the shadow models are trained on datasets that does not contain the target sample.
+            elif config.attack in ("lira", "rmia"):
+                # In offline LiRA/RMIA, the shadow models are trained on datasets that does not contain the target sample.
                 # Therefore we make a disjoint split and train shadow models on one part, and attack samples of the other part.
-                target_dataset, population = datasetup.target_shadow_split(dataset, split="disjoint", target_frac=0.5, shadow_frac=0.5)
+                share_shadow_models = config.share_shadow_models and attack is not None
+                if share_shadow_models:
+                    # The shadow models only depend on the population, so with a fixed split
+                    # they are trained once, and only the target model is retrained on new masks.
+                    datasetup.resample_masks(target_dataset)
+                else:
+                    target_dataset, population = datasetup.target_shadow_split(dataset, split="disjoint", target_frac=0.5, shadow_frac=0.5)
                 target_model = self.train_target_model(target_dataset)
-                metrics = attacks.LiRA(
-                    target_model=target_model,
-                    population=population,
-                    config=config,
-                ).run_attack(target_samples=target_dataset)
-                
-            elif config.attack == "rmia":
-                target_dataset, population = datasetup.target_shadow_split(dataset, split="disjoint", target_frac=0.5, shadow_frac=0.5)
-                target_model = self.train_target_model(target_dataset)
-                metrics = attacks.RMIA(
-                    target_model=target_model,
-                    population=population,
-                    config=config,
-                ).run_attack(target_samples=target_dataset)
+                if share_shadow_models:
+                    attack.set_target_model(target_model)
+                else:
+                    attack = (attacks.LiRA if config.attack == "lira" else attacks.RMIA)(
+                        target_model=target_model,
+                        population=population,
+                        config=config,
+                    )
+                metrics = attack.run_attack(target_samples=target_dataset)
 
             else:
                 raise AttributeError(f"No attack named {config.attack}")
@@ -173,23 +196,22 @@ class MembershipInferenceExperiment:
             metrics = dict(target_scores, **metrics)
 
             fpr, tpr = metrics['roc']
-            fprs.append(fpr)
-            tprs.append(tpr)
+            fprs[i], tprs[i] = fpr, tpr
             if best_auroc < metrics['auroc']:
                 best_auroc = metrics['auroc']
 
-            train_scores.append(metrics['train_score'])
-            test_scores.append(metrics['test_score'])
-            aurocs.append(metrics['auroc'])
+            train_scores[i] = metrics['train_score']
+            test_scores[i] = metrics['test_score']
+            aurocs[i] = metrics['auroc']
 
         if config.experiments > 1:
             stats = {
-                'train_acc_mean': [mean(train_scores)],
-                'train_acc_stdev': [stdev(train_scores)],
-                'test_acc_mean': [mean(test_scores)],
-                'test_acc_stdev': [stdev(test_scores)],
-                'auroc_mean': [mean(aurocs)],
-                'auroc_stdev': [stdev(aurocs)],
+                'train_acc_mean': [train_scores.mean()],
+                'train_acc_stdev': [train_scores.std(ddof=1)],
+                'test_acc_mean': [test_scores.mean()],
+                'test_acc_stdev': [test_scores.std(ddof=1)],
+                'auroc_mean': [aurocs.mean()],
+                'auroc_stdev': [aurocs.std(ddof=1)],
             }
         else:
             stats = {
@@ -232,19 +254,37 @@ if __name__ == '__main__':
     parser.add_argument("--hidden-dim-attack", default=[256, 64], type=lambda x: [*map(int, x.split(','))])
     parser.add_argument("--query-hops", default=0, type=int)
     parser.add_argument("--experiments", default=1, type=int)
+    parser.add_argument("--seed", default=0, type=int)
     parser.add_argument("--optimizer", default="Adam", type=str)
     parser.add_argument("--num-shadow-models", default=128, type=int)
+    parser.add_argument("--num-streams", default=1, type=int)
+    parser.add_argument("--amp", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--amp-dtype", default="bfloat16", type=str)
+    parser.add_argument("--multi-gpu", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--compile", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--use-cache", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--share-shadow-models", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--feature-dtype", default="auto", type=str)
     parser.add_argument("--rmia-offline-interp-param", default=0.1, type=float)
     parser.add_argument("--name", default="unnamed", type=str)
     parser.add_argument("--datadir", default="./data", type=str)
     parser.add_argument("--savedir", default="./results", type=str)
+    parser.add_argument("--cachedir", default="./cache", type=str)
     args = parser.parse_args()
     config = vars(args)
     config['make_plots'] = True
     print('Running MIA experiment.')
-    print(utils.Config(config))
+    print(utils.Config.from_dict(config))
     print()
     stat_df, roc_df = main(config)
     print('Attack statistics:')
     print(stat_df)
-    roc_df.to_csv(f'{args.savedir}/roc_{args.name}.csv', index=False)
+    # The ROC curve may have one point per target sample, so it is written with NumPy's writer instead of pandas'.
+    np.savetxt(
+        f'{args.savedir}/roc_{args.name}.csv',
+        roc_df.to_numpy(),
+        fmt='%.6g',
+        delimiter=',',
+        header=','.join(roc_df.columns),
+        comments='',
+    )
@@ -13,6 +13,17 @@ ArrayType = Union[np.ndarray, torch.tensor]
 def looper(iterable, use_tqdm, desc=""):
     return tqdm(iterable, desc=desc) if use_tqdm else iterable
 
+def autocast(device, enabled=True, dtype=torch.bfloat16):
+    ''' Mixed precision context (BF16 by default) on CUDA devices, no-op on other devices. '''
+    enabled = bool(enabled) and torch.device(device).type == 'cuda'
+    return torch.autocast(device_type='cuda', dtype=dtype, enabled=enabled)
+
+def accuracy(preds, target):
+    ''' Fraction of correct predictions, where preds are either class labels or scores over the classes. '''
+    if preds.dim() == target.dim() + 1:
+        preds = preds.argmax(dim=-1)
+    return (preds == target).float().mean()
+
 @dataclass
 class TrainConfig:
     criterion: Callable[[ArrayType, ArrayType], float]
@@ -23,21 +34,30 @@ class TrainConfig:
     lr: float
     weight_decay: float
     optimizer: torch.optim.Optimizer
+    amp: bool = False
+    amp_dtype: torch.dtype = torch.bfloat16
 
-def train_step_gnn(model, dataset, optimizer, loss_fn, criterion):
+def train_step_gnn(model, dataset, optimizer, loss_fn, criterion, amp=False, amp_dtype=torch.bfloat16, scaler=None):
     model.train()
     optimizer.zero_grad()
-    out = model(dataset.x, dataset.edge_index)
+    with autocast(dataset.x.device, enabled=amp, dtype=amp_dtype):
+        out = model(dataset.x, dataset.edge_index).float()
     loss = loss_fn(out[dataset.train_mask], dataset.y[dataset.train_mask])
     score = criterion(out[dataset.train_mask].argmax(dim=1), dataset.y[dataset.train_mask])
-    loss.backward()
-    optimizer.step()
+    if scaler is None:
+        loss.backward()
+        optimizer.step()
+    else:
+        # FP16 gradients may underflow, so the loss is scaled up before the backward pass.
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
     return loss.item() / dataset.train_mask.sum().item(), score.item()
 
-def valid_step_gnn(model, dataset, loss_fn, criterion):
+def valid_step_gnn(model, dataset, loss_fn, criterion, amp=False, amp_dtype=torch.bfloat16):
     model.eval()
-    with torch.inference_mode():
-        out = model(dataset.x, dataset.edge_index)
+    with torch.inference_mode(), autocast(dataset.x.device, enabled=amp, dtype=amp_dtype):
+        out = model(dataset.x, dataset.edge_index).float()
         loss = loss_fn(out[dataset.val_mask], dataset.y[dataset.val_mask])
         score = criterion(out[dataset.val_mask].argmax(dim=1), dataset.y[dataset.val_mask])
     return loss.item() / dataset.val_mask.sum().item(), score.item()
@@ -47,13 +67,15 @@ def train_gnn(model, dataset, config: TrainConfig, use_tqdm=True):
     dataset.to(config.device)
     optimizer = config.optimizer(model.parameters(), lr=config.lr, weight_decay=config.weight_decay)
     loss_fn, criterion = config.loss_fn, config.criterion
+    amp = config.amp and torch.device(config.device).type == 'cuda'
+    scaler = torch.amp.GradScaler('cuda') if amp and config.amp_dtype == torch.float16 else None
     res = defaultdict(list)
     early_stopping_counter = 0
     min_loss = float('inf')
     best_model = None
     for _ in looper(range(config.epochs), use_tqdm, desc=f"Training {model.__class__.__name__} on {config.device}"):
-        train_loss, train_score = train_step_gnn(model, dataset, optimizer, loss_fn, criterion)
-        valid_loss, valid_score = valid_step_gnn(model, dataset, loss_fn, criterion)
+        train_loss, train_score = train_step_gnn(model, dataset, optimizer, loss_fn, criterion, amp=amp, amp_dtype=config.amp_dtype, scaler=scaler)
+        valid_loss, valid_score = valid_step_gnn(model, dataset, loss_fn, criterion, amp=amp, amp_dtype=config.amp_dtype)
         res['train_loss'].append(train_loss)
         res['train_score'].append(train_score)
         res['valid_loss'].append(valid_loss)
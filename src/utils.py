@@ -5,20 +5,99 @@ import pandas as pd
 import scipy.stats as stats
 import matplotlib.pyplot as plt
 import torch
-import torch_geometric.nn as gnn
 from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from copy import deepcopy
+from dataclasses import dataclass, fields
+from functools import lru_cache
 from pathlib import Path
 from time import perf_counter
+from typing import Sequence
 
+try:
+    from cuml.manifold import TSNE # GPU t-SNE, if RAPIDS is installed.
+    TSNE_KWARGS = {}
+except ImportError:
+    from sklearn.manifold import TSNE
+    TSNE_KWARGS = {'n_jobs': -1}
+
+@dataclass(slots=True, frozen=True)
 class Config:
+    ''' Experiment configuration. The defaults match the command line defaults of run_mia.py. '''
+    attack: str = "basic-shadow"
+    dataset: str = "cora"
+    split: str = "sampled"
+    model: str = "GCN"
+    batch_size: int = 32
+    epochs_target: int = 500
+    epochs_attack: int = 100
+    grid_search: bool = False
+    lr: float = 1e-2
+    weight_decay: float = 1e-4
+    dropout: float = 0.5
+    early_stopping: bool = False
+    hidden_dim_target: int = 32
+    hidden_dim_attack: Sequence[int] = (256, 64)
+    query_hops: int = 0
+    experiments: int = 1
+    seed: int = 0
+    optimizer: str = "Adam"
+    num_shadow_models: int = 128
+    num_streams: int = 1
+    amp: bool = False
+    amp_dtype: str = "bfloat16"
+    multi_gpu: bool = False
+    compile: bool = False
+    use_cache: bool = False
+    share_shadow_models: bool = False
+    feature_dtype: str = "auto"
+    rmia_offline_interp_param: float = 0.1
+    name: str = "unnamed"
+    datadir: str = "./data"
+    savedir: str = "./results"
+    cachedir: str = "./cache"
+    make_plots: bool = False
+    device: str = "cpu"
 
-    def __init__(self, dictionary):
-        self.__dict__.update(dictionary)
+    @classmethod
+    def from_dict(cls, dictionary):
+        '''
+        Construct from a dictionary of parameters, ignoring keys that are not configuration fields.
+        None values (e.g. unset boolean command line flags) fall back to the field defaults.
+        '''
+        names = {field.name for field in fields(cls)}
+        return cls(**{k: v for k, v in dictionary.items() if k in names and v is not None})
 
     def __str__(self):
-        return '\n'.join(f'{k}: {v}'.replace('_', ' ') for k, v in self.__dict__.items())
+        return '\n'.join(f'{field.name}: {getattr(self, field.name)}'.replace('_', ' ') for field in fields(self))
+
+class RunningMoments:
+    '''
+    Mean and (unbiased) standard deviation along the first dimension of a stream of batches,
+    accumulated with the parallel version of Welford's algorithm.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, batch):
+        n = batch.shape[0]
+        batch_mean = batch.mean(dim=0)
+        batch_m2 = ((batch - batch_mean) ** 2).sum(dim=0)
+        if self.count == 0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            delta = batch_mean - self.mean
+            total = self.count + n
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * n / total
+        self.count += n
+
+    @property
+    def std(self):
+        return (self.m2 / (self.count - 1)).sqrt()
 
 class GraphInfo:
 
@@ -28,9 +107,8 @@ class GraphInfo:
         self.num_edges = dataset.edge_index.shape[1]
         self.num_features = dataset.num_features
         self.num_classes = dataset.num_classes
-        self.class_counts = np.zeros(self.num_classes)
-        for c in dataset.y:
-            self.class_counts[c] += 1
+        labels = torch.as_tensor(dataset.y).view(-1)
+        self.class_counts = torch.bincount(labels, minlength=self.num_classes).cpu().numpy().astype(np.float64)
         self.class_distr = self.class_counts / self.num_nodes
 
     def __str__(self):
@@ -44,24 +122,48 @@ class GraphInfo:
         )
         return s
 
-def fresh_model(model_type, num_features, hidden_dim, num_classes, dropout=0.0):
-    if model_type == 'GCNConv':
-        return gnn.GCNConv(in_channels=num_features, out_channels=num_classes)
+def compile_model(model, dynamic=True):
+    '''
+    Compiles the model with torch.compile when PyTorch 2 and a CUDA device are available, otherwise returns it as is.
+    Models trained on graphs of varying size need dynamic shapes, while a fixed graph lets the compiler specialize.
+    '''
+    if not hasattr(torch, 'compile') or not torch.cuda.is_available():
+        return model
+    return torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=dynamic)
+
+@lru_cache(maxsize=32)
+def model_template(model_type, num_features, hidden_dim, num_classes, dropout=0.0):
+    ''' Construct a model once per configuration. Fresh models are initialized copies of the template. '''
     try:
-        model = getattr(models, model_type)(
+        return getattr(models, model_type)(
             in_dim=num_features,
             hidden_dim=hidden_dim,
             out_dim=num_classes,
             dropout=dropout,
         )
     except AttributeError:
-        raise AttributeError(f'Unsupported model {model_type}. Supported models are GCN, SGC, GraphSAGE, GAT and GIN.')
-    return model
+        raise AttributeError(f'Unsupported model {model_type}. Supported models are GCN, SGC, GraphSAGE, GAT, GIN, DecoupledGCN and GCNConv.')
 
-def hinge_loss(pred, target):
-    mask = torch.ones_like(pred, dtype=bool)
-    mask[np.arange(target.shape[0]), target] = False
-    return pred[~mask] - torch.max(pred[mask].reshape(target.shape[0], -1), dim=1).values
+def fresh_model(model_type, num_features, hidden_dim, num_classes, dropout=0.0, compile=False, dynamic=True):
+    model = deepcopy(model_template(model_type, num_features, hidden_dim, num_classes, dropout))
+    model.reset_parameters()
+    return compile_model(model, dynamic=dynamic) if compile else model
+
+@torch.jit.script
+def hinge_loss(pred: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    ''' Difference between the logit of the true label and the largest logit of the other labels. '''
+    index = target.unsqueeze(1)
+    true_logit = pred.gather(1, index).squeeze(1)
+    other_logits = pred.scatter(1, index, float('-inf'))
+    return true_logit - other_logits.max(dim=1).values
+
+def true_label_confidence(pred, target):
+    '''
+    Softmax confidence of the true label, computed in log-space without materializing the full softmax.
+    The leading dimensions of pred (e.g. a dimension for multiple models) broadcast against target.
+    '''
+    index = target.expand(pred.shape[:-1]).unsqueeze(-1)
+    return (pred.gather(-1, index).squeeze(-1) - pred.logsumexp(dim=-1)).exp()
 
 def measure_execution_time(callable):
     def wrapper(*args, **kwargs):
@@ -72,9 +174,18 @@ def measure_execution_time(callable):
         return ret
     return wrapper
 
+def reused_figure(num='plot', figsize=(8, 8)):
+    '''
+    Makes the figure with label num current and clears it. Figures are created once per process and
+    reused by the plotting helpers, instead of allocating and closing a new canvas for every plot.
+    '''
+    fig = plt.figure(num=num, figsize=figsize)
+    fig.clear()
+    return fig
+
 def plot_training_results(res, name, savedir):
     epochs = np.array([*range(len(res['train_loss']))])
-    plt.figure(figsize=(15, 15))
+    reused_figure(num='grid', figsize=(15, 15))
     plt.subplot(2, 2, 1)
     plt.plot(epochs, res['train_loss'], label='train loss')
     plt.xlabel("Epochs")
@@ -95,22 +206,42 @@ def plot_training_results(res, name, savedir):
     plt.xlabel("Epochs")
     plt.ylabel("Score")
     plt.grid(True)
-    Path(savedir).mkdir(parents=True, exist_ok=True)
-    plt.savefig(f"{savedir}/training_results_{name}.png")
-    plt.close()
+    savefig_or_show(Path(savedir) / f"training_results_{name}.png")
+
+created_dirs = set() # Directories created by savefig_or_show, so that each is only created once per process.
 
 def savefig_or_show(savepath=None):
     if savepath:
-        savedir = '/'.join(savepath.split('/')[:-1])
-        Path(savedir).mkdir(parents=True, exist_ok=True)
-        plt.savefig(savepath)
+        savepath = Path(savepath)
+        if savepath.parent not in created_dirs:
+            savepath.parent.mkdir(parents=True, exist_ok=True)
+            created_dirs.add(savepath.parent)
+        try:
+            plt.savefig(savepath)
+        except FileNotFoundError:
+            # The directory was removed since it was created (e.g. the embeddings directory is cleared per run).
+            savepath.parent.mkdir(parents=True, exist_ok=True)
+            plt.savefig(savepath)
     else:
         plt.show()
-    plt.close()
+
+def logspace_subsample(fpr, tpr, n=500):
+    '''
+    Subsample a ROC curve to at most about n points, log-spaced in fpr. Points closer than a pixel on a
+    log-log axis are dropped, which cuts the rendering cost of curves with one point per sample.
+    '''
+    fpr, tpr = np.asarray(fpr), np.asarray(tpr)
+    if len(fpr) <= n:
+        return fpr, tpr
+    grid = np.logspace(np.log10(max(fpr[fpr > 0].min(initial=1.0), 1e-6)), 0, n)
+    # Last point at or below each grid value, i.e. the highest tpr reached at that fpr.
+    index = np.clip(np.searchsorted(fpr, grid, side='right') - 1, 0, len(fpr) - 1)
+    index = np.unique(np.concatenate(([0], index, [len(fpr) - 1])))
+    return fpr[index], tpr[index]
 
 def plot_roc_loglog(fpr, tpr, title=None, savepath=None):
-    plt.figure(figsize=(8, 8))
-    plt.loglog(fpr, tpr)
+    reused_figure()
+    plt.loglog(*logspace_subsample(fpr, tpr))
     plt.xlim(1e-4, 1)
     plt.ylim(1e-4, 1)
     plt.grid(True)
@@ -120,9 +251,9 @@ def plot_roc_loglog(fpr, tpr, title=None, savepath=None):
     savefig_or_show(savepath)
 
 def plot_multi_roc_loglog(fprs, tprs, train_accs, test_accs, title=None, savepath=None):
-    plt.figure(figsize=(8, 8))
+    reused_figure()
     for fpr, tpr, train_acc, test_acc in zip(fprs, tprs, train_accs, test_accs):
-        plt.loglog(fpr, tpr, label=f'Train acc: {train_acc:.4f} | Test acc: {test_acc:.4f}')
+        plt.loglog(*logspace_subsample(fpr, tpr), label=f'Train acc: {train_acc:.4f} | Test acc: {test_acc:.4f}')
     plt.xlim(1e-4, 1)
     plt.ylim(1e-4, 1)
     plt.grid(True)
@@ -141,7 +272,7 @@ def plot_roc_csv(filepath, savedir=None):
             plot_roc_loglog(df[s], df[t], title=name, savepath=f'{savedir}/{name}.png')
 
 def plot_histogram_and_fitted_gaussian(x, mean, std, bins=10, savepath=None):
-    plt.figure(figsize=(8, 8))
+    reused_figure()
     plt.hist(x=x, bins=bins, density=True)
     plt.grid(True)
     xmin, xmax = plt.xlim()
@@ -151,7 +282,7 @@ def plot_histogram_and_fitted_gaussian(x, mean, std, bins=10, savepath=None):
     savefig_or_show(savepath)
 
 def plot_fitted_gaussians(means, stds, savepath=None):
-    plt.figure(figsize=(8, 8))
+    reused_figure()
     xs = np.linspace(-50, 50)
     for i, (mean, std) in enumerate(zip(means, stds)):
         ys = stats.norm.pdf(xs, loc=mean, scale=std+1e-6)
@@ -164,11 +295,15 @@ def plot_embedding_2D_scatter(embs, mask, savepath=None):
     length = mask.shape[0]
     trunc_length = 3000
     if length > trunc_length:
-        rand_index = torch.randint(low=0, high=length-1, size=(trunc_length,))
+        rand_index = torch.randperm(length, device=embs.device)[:trunc_length]
         embs = embs[rand_index]
         mask = mask[rand_index]
-    x = TSNE(n_components=2).fit_transform(embs)
-    plt.figure(figsize=(8, 8))
+    if torch.is_tensor(embs):
+        embs = embs.cpu().numpy()
+    if torch.is_tensor(mask):
+        mask = mask.cpu().numpy()
+    x = TSNE(n_components=2, **TSNE_KWARGS).fit_transform(embs)
+    reused_figure()
     plt.scatter(x[mask, 0], x[mask, 1], c='blue', marker='o')
     plt.scatter(x[~mask, 0], x[~mask, 1], c='red', marker='x')
     plt.grid(True)
@@ -177,14 +312,14 @@ def plot_embedding_2D_scatter(embs, mask, savepath=None):
 def plot_embedding_hist(embs, mask, savepath=None):
     x = LinearDiscriminantAnalysis(n_components=1).fit_transform(X=embs, y=mask.long())
     bins = 50
-    plt.figure(figsize=(8, 8))
+    reused_figure()
     plt.hist(x=x[mask], bins=bins)
     plt.hist(x=x[~mask], bins=bins)
     plt.grid(True)
     savefig_or_show(savepath)
 
 def plot_hinge_histogram(hinge, label_mask, train_mask, savepath=None):
-    plt.figure(figsize=(8, 8))
+    reused_figure()
     bins = min(50, 2 * len({x.item() for x in hinge}))
     plt.hist(hinge[train_mask & label_mask], bins=bins)
     plt.hist(hinge[~train_mask & label_mask], bins=bins)